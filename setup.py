@@ -12,6 +12,8 @@ setup(
         "requests==2.21.0",
         "jsonref==0.2",
         "jsonschema==2.6.0",
+        "fastjsonschema==2.16.2",
         "flattentool==0.5.0",
+        "orjson==3.8.3",
     ]
 )
@@ -1,3 +1,5 @@
+import io
+import json
 import tempfile
 import os
 
@@ -6,6 +8,7 @@ import requests_mock
 import pandas
 
 from threesixty import ThreeSixtyGiving, Grant, ParseError
+from threesixty import threesixty as threesixty_module
 
 @pytest.fixture
 def get_file():
@@ -37,6 +40,198 @@ def test_json(get_file, m):
     # @TODO: add test for invalid JSON
 
 
+def test_json_large_integers():
+    # orjson can't read integers over 64 bits exactly
+    contents = '{"grants": [{"id": "360G-1", "amountAwarded": 123456789012345678901234567890}]}'
+    for f in [io.StringIO(contents), io.BytesIO(contents.encode('utf-8'))]:
+        g = ThreeSixtyGiving.from_json(f, validate=False)
+        assert g.data["grants"][0]["amountAwarded"] == 123456789012345678901234567890
+
+    t_, t = tempfile.mkstemp(suffix='.json')
+    with os.fdopen(t_, 'w', encoding='utf-8-sig') as f_:
+        f_.write(contents)
+    g = ThreeSixtyGiving.from_json(t, validate=False)
+    assert g.data["grants"][0]["amountAwarded"] == 123456789012345678901234567890
+    os.remove(t)
+
+    # or write them
+    f = io.StringIO()
+    g.to_json(f)
+    assert json.loads(f.getvalue()) == json.loads(contents)
+
+
+def test_json_long_integer_chunks(monkeypatch):
+    # a long integer is still found if it crosses a chunk boundary
+    monkeypatch.setattr(threesixty_module, 'LONG_INTEGER_CHUNK_SIZE', 16)
+    contents = b'{"grants": [{"amountAwarded": 123456789012345678901234567890}]}'
+    assert contents.index(b'1234') < 32 < contents.index(b'890')
+    assert threesixty_module.has_long_integer(memoryview(contents))
+    assert not threesixty_module.has_long_integer(memoryview(contents.replace(b'012', b'0.1')))
+    g = ThreeSixtyGiving.from_json(io.BytesIO(contents), validate=False)
+    assert g.data["grants"][0]["amountAwarded"] == 123456789012345678901234567890
+
+
+def test_json_nan():
+    # orjson doesn't accept NaN, but the json module does
+    for f in [io.StringIO('{"grants": [{"a": NaN}]}'), io.BytesIO(b'{"grants": [{"a": NaN}]}')]:
+        g = ThreeSixtyGiving.from_json(f, validate=False)
+        assert g.data["grants"][0]["a"] != g.data["grants"][0]["a"]
+
+    with pytest.raises(json.JSONDecodeError):
+        ThreeSixtyGiving.from_json(io.StringIO('{"grants": ['), validate=False)
+
+
+def test_fast_check_draft4():
+    # under draft 4 a float isn't an integer, even if it's a whole number
+    schema = {
+        "type": "object",
+        "properties": {
+            "grants": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {"durationMonths": {"type": "integer"}},
+                },
+            },
+        },
+    }
+    g = ThreeSixtyGiving({"grants": [{"durationMonths": 12.0}]}, schema=schema)
+    assert not g.fast_check()
+    assert not g.is_valid()
+    assert [e.message for e in g.errors] == ["12.0 is not of type 'integer'"]
+
+
+def test_fast_check_dates():
+    # dates can be either a date-time or a date
+    schema = {
+        "type": "object",
+        "properties": {
+            "grants": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "awardDate": {
+                            "type": "string",
+                            "oneOf": [{"format": "date-time"}, {"format": "date"}],
+                        },
+                    },
+                },
+            },
+        },
+    }
+    g = ThreeSixtyGiving({"grants": [
+        {"awardDate": "2017-12-08T00:00:00+00:00"},
+        {"awardDate": "2017-12-08"},
+    ]}, schema=schema)
+    assert g.fast_validator is not None
+    assert g.fast_check()
+    assert g.is_valid()
+    assert not g.fast_check({"grants": [{"awardDate": "2017-13-08"}]})
+
+
+def test_schema_cache(get_file, m):
+    ThreeSixtyGiving.schema_cache.clear()
+    for i in range(2):
+        g = ThreeSixtyGiving.from_json(
+            get_file("sample_data/ExampleTrust-grants-fixed.json"))
+        assert g.is_valid()
+    schema_requests = [r for r in m.request_history if r.url == ThreeSixtyGiving.schema_url]
+    assert len(schema_requests) == 1
+    assert ThreeSixtyGiving.schema_url in ThreeSixtyGiving.schema_cache
+    assert g.fast_validator is not None
+
+    # changes to one instance's schema and fieldnames don't affect the others
+    g.schema["properties"].clear()
+    g.replace_names["id"] = "Changed"
+    g.replace_index.clear()
+    h = ThreeSixtyGiving.from_json(
+        get_file("sample_data/ExampleTrust-grants-fixed.json"))
+    assert "grants" in h.schema["properties"]
+    assert h.replace_names["id"] != "Changed"
+    assert h.replace_index
+
+
+def test_session_retries():
+    # requests_mock bypasses the adapters, so check how they're set up
+    session = ThreeSixtyGiving.get_session()
+    for prefix in ['http://', 'https://']:
+        retries = session.adapters[prefix].max_retries
+        assert retries.total == 3
+        assert 503 in retries.status_forcelist
+        assert retries.raise_on_status is False
+
+
+def test_parallel_errors(get_file, m, monkeypatch):
+    # record that the worker processes are actually used
+    pools = []
+
+    class RecordingExecutor(threesixty_module.ProcessPoolExecutor):
+        def __init__(self, *args, **kwargs):
+            pools.append(kwargs.get('max_workers'))
+            super().__init__(*args, **kwargs)
+
+    monkeypatch.setattr(threesixty_module, 'ProcessPoolExecutor', RecordingExecutor)
+
+    g = ThreeSixtyGiving.from_json(
+        get_file("sample_data/ExampleTrust-grants-fixed.json"))
+    assert g.fast_validator is not None
+    assert list(g.get_errors_parallel(workers=2, chunksize=3)) == []
+
+    g.data["grants"][4]["amountAwarded"] = "five thousand"
+    del g.data["grants"][7]["title"]
+    errors = list(g.get_errors_parallel(workers=2, chunksize=3))
+    assert sorted(list(e.path) for e in errors) == [
+        ["grants", 4, "amountAwarded"], ["grants", 7]]
+    assert sorted(e.message for e in errors) == sorted(
+        e.message for e in g.get_errors())
+
+    # the grant schema has no `$schema` of its own, but is still checked
+    # using draft 4, where a float isn't an integer
+    schema = {
+        "$schema": "http://json-schema.org/draft-04/schema#",
+        "type": "object",
+        "properties": {
+            "grants": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {"durationMonths": {"type": "integer"}},
+                },
+            },
+        },
+    }
+    g = ThreeSixtyGiving(
+        {"grants": [{"durationMonths": 12}, {"durationMonths": 12.0}]}, schema=schema)
+    assert g.fast_validator is not None
+    errors = list(g.get_errors_parallel(workers=2, chunksize=1))
+    assert [e.message for e in errors] == ["12.0 is not of type 'integer'"]
+    assert [list(e.path) for e in errors] == [["grants", 1, "durationMonths"]]
+    assert [e.message for e in errors] == [e.message for e in g.get_errors()]
+    assert pools == [2, 2, 2]
+
+
+def test_parallel_errors_fallback():
+    # a schema fastjsonschema can't compile is checked in this process, with a warning
+    schema = {
+        "type": "object",
+        "properties": {
+            "grants": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {"title": {"type": "string", "format": "not-a-format"}},
+                },
+            },
+        },
+    }
+    g = ThreeSixtyGiving({"grants": [{"title": "a"}, {"title": 1}]}, schema=schema)
+    assert g.fast_validator is None
+    with pytest.warns(RuntimeWarning):
+        errors = list(g.get_errors_parallel(workers=2))
+    assert [e.message for e in errors] == ["1 is not of type 'string'"]
+
+
 def test_csv(get_file, m):
     g = ThreeSixtyGiving.from_csv(
         get_file("sample_data/ExampleTrust-grants-fixed.csv"))
@@ -126,6 +321,60 @@ def test_output(get_file, m):
     assert grants[2].id == '360G-KJD-001232'
 
 
+def test_grant_to_flat():
+    g = Grant(**{
+        "id": "360G-KJD-001230",
+        "amountAwarded": 5000,
+        "recipientOrganization": [{"id": "GB-CHC-265374", "name": "Blue Trust"}],
+        "beneficiaryLocation": [{"name": "Leeds"}, {"name": "York", "geoCode": "E06000014"}],
+        "dataSource": "http://www.example.org/grants.htm",
+    })
+    assert list(g.to_flat().items()) == [
+        ("id", "360G-KJD-001230"),
+        ("amountAwarded", 5000),
+        ("recipientOrganization.0.id", "GB-CHC-265374"),
+        ("recipientOrganization.0.name", "Blue Trust"),
+        ("beneficiaryLocation.0.name", "Leeds"),
+        ("beneficiaryLocation.1.name", "York"),
+        ("beneficiaryLocation.1.geoCode", "E06000014"),
+        ("dataSource", "http://www.example.org/grants.htm"),
+    ]
+
+
+def test_convert_fieldnames():
+    schema = {
+        "type": "object",
+        "properties": {
+            "grants": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "id": {"type": "string", "title": "ID"},
+                        "recipientOrganization": {
+                            "type": "array",
+                            "items": {
+                                "type": "object",
+                                "properties": {"name": {"type": "string", "title": "Name"}},
+                            },
+                        },
+                    },
+                },
+            },
+        },
+    }
+    g = ThreeSixtyGiving({"grants": []}, schema=schema)
+    fieldnames = ["id", "recipientOrganization.0.name", "title"]
+    assert list(g.convert_fieldnames(fieldnames).values()) == [
+        "ID", "recipientOrganization:0:Name", "title"]
+
+    # changes to replace_names are used
+    g.replace_names["id"] = "Identifier"
+    g.replace_names["title"] = "Title"
+    assert list(g.convert_fieldnames(fieldnames).values()) == [
+        "Identifier", "recipientOrganization:0:Name", "Title"]
+
+
 def test_pandas_output(get_file, m):
     g = ThreeSixtyGiving.from_file(
         get_file("sample_data/ExampleTrust-grants-fixed.xlsx"), "xlsx")
@@ -199,6 +448,25 @@ def test_json_output(get_file, m):
     assert h.is_valid()
 
 
+def test_json_output_fileobj():
+    grants = {"grants": [{"id": "360G-KJD-001230", "title": "Grant award to Blue Trust £"}]}
+    g = ThreeSixtyGiving(grants)
+
+    for f in [io.StringIO(), tempfile.NamedTemporaryFile('w+', encoding='utf-8'),
+              tempfile.SpooledTemporaryFile(mode='w+')]:
+        g.to_json(f)
+        f.seek(0)
+        assert json.loads(f.read()) == grants
+        f.close()
+
+    for f in [io.BytesIO(), tempfile.NamedTemporaryFile('w+b'),
+              tempfile.SpooledTemporaryFile(mode='w+b')]:
+        g.to_json(f)
+        f.seek(0)
+        assert json.loads(f.read().decode('utf-8')) == grants
+        f.close()
+
+
 def test_csv_output(get_file, m):
     t_, t = tempfile.mkstemp(suffix='.csv')
     os.close(t_)
@@ -217,4 +485,29 @@ def test_encodings(get_file):
     assert encoding[1] == 'latin_1'
     f = get_file(os.path.join('sample_encodings', 'utf8.txt'))
     encoding = ThreeSixtyGiving.guess_encoding(f)
-    assert encoding[1] == 'utf-8-sig'
\ No newline at end of file
+    assert encoding[1] == 'utf-8-sig'
+
+
+def test_encoding_sample_boundary():
+    # a multi-byte character split by the end of the sample is still utf-8
+    t_, t = tempfile.mkstemp(suffix='.csv')
+    os.close(t_)
+    with open(t, 'w', encoding='utf-8') as f_:
+        f_.write('a' * 9 + '£' * 10)
+    encoding = ThreeSixtyGiving.guess_encoding(t, sample_size=10)
+    encoding[0].close()
+    assert encoding[1] == 'utf-8-sig'
+    os.remove(t)
+
+
+def test_encoding_past_sample():
+    # the first character that isn't valid UTF-8 comes after the sample
+    t_, t = tempfile.mkstemp(suffix='.json')
+    os.close(t_)
+    padding = 'a' * threesixty_module.ENCODING_SAMPLE_SIZE
+    with open(t, 'w', encoding='cp1252') as f_:
+        json.dump({"grants": [{"id": padding, "title": "£100"}]}, f_, ensure_ascii=False)
+    assert list(ThreeSixtyGiving.possible_encodings(t)) == ['utf-8-sig', 'cp1252', 'latin_1']
+    g = ThreeSixtyGiving.from_json(t, validate=False)
+    assert g.data["grants"][0]["title"] == "£100"
+    os.remove(t)
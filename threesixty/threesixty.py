@@ -1,38 +1,193 @@
+import codecs
+import copy
+import io
 import json
+import mmap
 import tempfile
+import warnings
+from concurrent.futures import ProcessPoolExecutor
 import os
 import csv
+import datetime
 import re
+import shutil
 from collections import OrderedDict
 
+import fastjsonschema
 import flattentool
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
 from urllib.parse import urlparse
-from jsonref import JsonRef
+from urllib3.util.retry import Retry
+from jsonref import JsonLoader, JsonRef
 from jsonschema import Draft4Validator, FormatChecker
 
 ENCODINGS_TO_CHECK = ['utf-8-sig', 'cp1252', 'latin_1', 'ansi']
+ENCODING_SAMPLE_SIZE = 65536
 CONTENT_TYPE_MAP = {
     'application/json': 'json',
     'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet': 'xlsx',
     'text/csv': 'csv'
 }
+CONTENT_DISPOSITION_FILENAME = re.compile(r'filename="?([^";]+)"?')
+JSON_SCHEMA_DRAFT_4 = 'http://json-schema.org/draft-04/schema#'
+# a run of this many digits could be an integer too big for orjson to read exactly
+LONG_INTEGER_DIGITS = 19
+# maps every digit to b'0', so a run of digits can be found with a substring search
+DIGIT_TABLE = bytes.maketrans(b'123456789', b'000000000')
+LONG_INTEGER_CHUNK_SIZE = 1 << 20
+
+
+def has_long_integer(view):
+    """
+    Check whether bytes contain a run of `LONG_INTEGER_DIGITS` or more digits
+
+    This is much quicker than a regular expression search. The bytes are
+    checked in chunks so a large memory-mapped file isn't copied all at once.
+
+    :param view: a memoryview of the bytes to check
+    :return: True if there is a long run of digits
+    """
+    run = b'0' * LONG_INTEGER_DIGITS
+    for start in range(0, len(view), LONG_INTEGER_CHUNK_SIZE):
+        # overlap the chunks so a run crossing a boundary is still found
+        chunk = view[start:start + LONG_INTEGER_CHUNK_SIZE + LONG_INTEGER_DIGITS - 1]
+        if run in bytes(chunk).translate(DIGIT_TABLE):
+            return True
+    return False
+
+
+def is_date(value):
+    """
+    Check a string is a date in the form `YYYY-MM-DD`, in the same way as
+    the `date` format check in `jsonschema.FormatChecker`
+
+    :param str value: The string to check
+    :rtype: bool
+    """
+    try:
+        datetime.datetime.strptime(value, '%Y-%m-%d')
+    except ValueError:
+        return False
+    return True
+
+
+def compile_fast_validator(schema):
+    """
+    Compile a schema into a validation function using `fastjsonschema`
+
+    The schema is always compiled using draft 4 rules, to match the
+    `jsonschema.Draft4Validator` used to find errors. Otherwise `fastjsonschema`
+    would use the `$schema` in the schema, or draft 7 if there isn't one.
+    `fastjsonschema` doesn't have a `date` format for draft 4 (which
+    the 360Giving schema uses) so `is_date()` is used for it.
+
+    :param dict schema: The schema to compile
+    :return: Function that raises `fastjsonschema.JsonSchemaException` if given invalid data
+    """
+    schema = dict(schema)
+    schema['$schema'] = JSON_SCHEMA_DRAFT_4
+    return fastjsonschema.compile(schema, formats={'date': is_date}, use_default=False)
+
+
+# compiled validator for grants, used by the worker processes in
+# `ThreeSixtyGiving.get_errors_parallel()`. Compiled validators can't be
+# pickled so each worker compiles its own from the schema
+worker_grant_validator = None
+
+
+def init_grant_validator(schema):
+    """
+    Compile the grant schema in a worker process
+
+    The grant schema is part of the package schema so has no `$schema`
+    of its own, but is still compiled with draft 4 rules
+
+    :param dict schema: Schema for an individual grant
+    """
+    global worker_grant_validator
+    worker_grant_validator = compile_fast_validator(schema)
+
+
+def find_invalid_grants(chunk):
+    """
+    Check a chunk of grants in a worker process
+
+    :param tuple chunk: a tuple of (index of the first grant, list of grants)
+    :return: List of the indexes of any invalid grants
+    :rtype: list
+    """
+    start, grants = chunk
+    invalid = []
+    for i, g in enumerate(grants, start):
+        try:
+            worker_grant_validator(g)
+        except fastjsonschema.JsonSchemaException:
+            invalid.append(i)
+    return invalid
+
+
+def plain_schema(schema):
+    """
+    Copy a schema, replacing any `JsonRef` objects with plain dicts and lists
+    so that it can be pickled
+
+    :param schema: Schema which may contain `JsonRef` objects
+    :return: Copy of the schema
+    """
+    if isinstance(schema, dict):
+        return {k: plain_schema(v) for k, v in schema.items()}
+    if isinstance(schema, list):
+        return [plain_schema(v) for v in schema]
+    return schema
+
 
 class ParseError(Exception):
     def __init__(self, message, errors):
         super().__init__(message)
         self.errors = errors
 
+class SessionJsonLoader(JsonLoader):
+    """
+    A `jsonref` loader that fetches remote JSON documents using a `requests` session
+
+    Loaded documents are cached by the loader, so each URL is only fetched once
+    """
+
+    def __init__(self, session, **kwargs):
+        super().__init__(**kwargs)
+        self.session = session
+
+    def get_remote_json(self, uri, **kwargs):
+        if urlparse(uri).scheme in ['http', 'https']:
+            return self.session.get(uri).json(**kwargs)
+        return super().get_remote_json(uri, **kwargs)
+
+
 class ThreeSixtyGiving:
 
     root_id = 'grants'
     schema_url = 'https://raw.githubusercontent.com/ThreeSixtyGiving/standard/master/schema/360-giving-package-schema.json'
     user_agent = '360Giving data'
 
+    # schemas fetched from a URL, shared between instances
+    # key is the schema URL, value is a tuple of
+    # (schema, validator, fast_validator, replace_names, replace_index)
+    schema_cache = {}
+
+    # requests session and jsonref loader shared between instances, see `get_session()`
+    session = None
+    schema_loader = None
+
     def __init__(self, data=None, schema_url=None, schema=None):
         self.schema = None
         self.validator = None
+        self.fast_validator = None
         self.replace_names = OrderedDict()
+        self.replace_index = {}
+        # the `self.replace_names` that `self.replace_index` was built from
+        self.replace_index_names = OrderedDict()
 
         if schema_url:
             self.schema_url = schema_url
@@ -50,6 +205,34 @@ class ThreeSixtyGiving:
         else:
             self.data = {}
 
+    @classmethod
+    def get_session(cls):
+        """
+        Get the `requests` session used for fetching files and schemas
+
+        The session is created the first time it is needed, and keeps connections
+        open to be reused. Failed requests are retried.
+
+        :return: The session
+        :rtype: requests.Session
+        """
+        if cls.session is None:
+            session = requests.Session()
+            session.headers['User-Agent'] = cls.user_agent
+            adapter = HTTPAdapter(
+                pool_connections=4,
+                # return the last response rather than raising a RetryError, so
+                # `raise_for_status()` still raises an HTTPError for these codes
+                max_retries=Retry(total=3, backoff_factor=0.5,
+                                  status_forcelist=[500, 502, 503, 504],
+                                  raise_on_status=False),
+            )
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            cls.session = session
+            cls.schema_loader = SessionJsonLoader(session)
+        return cls.session
+
     def __iter__(self):
         """
         Iterating the object yields grant objects for each of the loaded grants
@@ -62,34 +245,39 @@ class ThreeSixtyGiving:
         """
         Fetches a 360Giving format file from an URL (using requests),
         guesses the filetype if not given, and then parses the file
+
+        Additional keyword arguments (eg `validate`) are passed to `cls.from_file()`
         """
 
-        # Attempt to fetch the file
-        r = requests.get(url, headers={'User-Agent': cls.user_agent})
-        r.raise_for_status()
-
-        # work out the filetype if not given
-        if not filetype:
-            content_type = r.headers.get('content-type', '').split(';')[0].lower()
-            if content_type and content_type in CONTENT_TYPE_MAP:
-                filetype = CONTENT_TYPE_MAP[content_type]
-            elif 'content-disposition' in r.headers:
-                d = r.headers['content-disposition']
-                filetype = re.search('filename=(.+)', d)
-                if filetype:
-                    filetype = filetype[0].split('.')[-1].strip('"')
-            else:
-                filetype = urlparse(url).path.split('.')[-1]
-            if filetype not in CONTENT_TYPE_MAP.values():
-                raise ValueError("Unrecognised file type [{}]".format(filetype))
-
-        # write the content to a temporary file
-        t_, t = tempfile.mkstemp(suffix='.{}'.format(filetype))
-        os.write(t_, r.content)
-        os.close(t_)
-        c = cls.from_file(t, filetype, **kwargs)
-        os.remove(t)
-        return c
+        # Attempt to fetch the file, streaming the response so the
+        # content isn't all held in memory
+        with cls.get_session().get(url, stream=True) as r:
+            r.raise_for_status()
+
+            # work out the filetype if not given
+            if not filetype:
+                content_type = r.headers.get('content-type', '').partition(';')[0].strip().lower()
+                if content_type and content_type in CONTENT_TYPE_MAP:
+                    filetype = CONTENT_TYPE_MAP[content_type]
+                elif 'content-disposition' in r.headers:
+                    filename = CONTENT_DISPOSITION_FILENAME.search(r.headers['content-disposition'])
+                    if filename:
+                        filetype = filename.group(1).rsplit('.', 1)[-1]
+                else:
+                    filetype = urlparse(url).path.split('.')[-1]
+                if filetype not in CONTENT_TYPE_MAP.values():
+                    raise ValueError("Unrecognised file type [{}]".format(filetype))
+
+            # write the content to a temporary file
+            t_, t = tempfile.mkstemp(suffix='.{}'.format(filetype))
+            with os.fdopen(t_, 'wb') as tmp_file:
+                for chunk in r.iter_content(chunk_size=1 << 20):
+                    tmp_file.write(chunk)
+
+        try:
+            return cls.from_file(t, filetype, **kwargs)
+        finally:
+            os.remove(t)
 
     @classmethod
     def from_file(cls, f, filetype, **kwargs):
@@ -102,7 +290,7 @@ class ThreeSixtyGiving:
         :param filetype: The type of file to be opened (one of ['csv', 'json', 'excel'])
         :return: Object of this class with data loaded
 
-        Additional keyword arguments are passed to the opening methods
+        Additional keyword arguments (eg `validate`) are passed to the opening methods
 
         @TODO: make `filetype` optional and guess the filetype if not given
         """
@@ -115,65 +303,86 @@ class ThreeSixtyGiving:
             return cls.from_excel(f, **kwargs)
 
     @classmethod
-    def from_csv(cls, f, encoding=None, **kwargs):
+    def from_csv(cls, f, encoding=None, validate=True, **kwargs):
         """
         Opens a CSV format 360Giving file, and return an object for accessing the data
 
-        :param str f: file path to be opened
+        :param f: file path to be opened or a binary file-like object with a `read()` method
         :param str encoding: will be passed to open(), will be guessed if not given
+        :param bool validate: Whether to validate the data after the file is converted
         :return: Object of this class with data loaded
 
-        Additional keyword arguments are passed to `cls.to_json()` which is used to parse the converted file
+        Additional keyword arguments are passed to `cls.from_json()` which is used to parse the converted file
+
+        `flattentool` doesn't check the data against the schema, so unless
+        `validate=False` is passed the converted data will be validated once,
+        by `cls.from_json()`
 
         @TODO: better version of unflatten which allows for returning the data not a temporary file
         """
 
         # `flattentool.unflatten` is designed to accept a directory of CSV files
         # so need to create a dummy directory
-        opened_file = False
-        if isinstance(f, str):
-            fileobj = open(f, 'rb')
-            opened_file = True
-        else:
-            fileobj = f
-        tmp_dir = tempfile.mkdtemp()
-        destination = os.path.join(tmp_dir, 'grants.csv')
-        with open(destination, 'wb') as dest_write:
-            dest_write.write(fileobj.read())
-        if not encoding:
-            destfileobj, encoding = cls.guess_encoding(destination)
-            destfileobj.close()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            destination = os.path.join(tmp_dir, 'grants.csv')
+            if isinstance(f, str):
+                # link to the original file rather than copying it if possible
+                try:
+                    os.symlink(os.path.abspath(f), destination)
+                except (OSError, NotImplementedError):
+                    shutil.copy(f, destination)
+            else:
+                with open(destination, 'wb') as dest_write:
+                    shutil.copyfileobj(f, dest_write)
+            if encoding:
+                encodings = [encoding]
+            else:
+                encodings = list(cls.possible_encodings(destination))
 
-        json_file, json_output = tempfile.mkstemp(suffix='.json')
-        os.close(json_file)
-        flattentool.unflatten(
-            tmp_dir,
-            output_name=json_output,
-            input_format="csv",
-            root_list_path=cls.root_id,
-            root_id='',
-            # @TODO: Need to better handle the schema here - there's duplication with the flattentool also fetching it
-            schema='https://raw.githubusercontent.com/ThreeSixtyGiving/standard/master/schema/360-giving-schema.json',
-            convert_titles=True,
-            encoding=encoding,
-            # I don't think this is used properly here
-            metatab_schema=cls.schema_url,
-            metatab_name='Meta',
-            metatab_vertical_orientation=True,
-        )
-        c = cls.from_json(json_output, **kwargs)
-        os.remove(json_output)
-        return c
+            json_file, json_output = tempfile.mkstemp(suffix='.json')
+            os.close(json_file)
+            try:
+                for i, encoding in enumerate(encodings):
+                    try:
+                        flattentool.unflatten(
+                            tmp_dir,
+                            output_name=json_output,
+                            input_format="csv",
+                            root_list_path=cls.root_id,
+                            root_id='',
+                            # @TODO: Need to better handle the schema here - there's duplication with the flattentool also fetching it
+                            schema='https://raw.githubusercontent.com/ThreeSixtyGiving/standard/master/schema/360-giving-schema.json',
+                            convert_titles=True,
+                            encoding=encoding,
+                            # I don't think this is used properly here
+                            metatab_schema=cls.schema_url,
+                            metatab_name='Meta',
+                            metatab_vertical_orientation=True,
+                        )
+                        break
+                    except UnicodeDecodeError:
+                        # the guessed encoding was only checked against the
+                        # start of the file, so try the next one
+                        if i == len(encodings) - 1:
+                            raise
+                return cls.from_json(json_output, validate=validate, **kwargs)
+            finally:
+                os.remove(json_output)
 
     @classmethod
-    def from_excel(cls, f, **kwargs):
+    def from_excel(cls, f, validate=True, **kwargs):
         """
         Opens an Excel format 360Giving file, and return an object for accessing the data
 
         :param str f: file path to an Excel file
+        :param bool validate: Whether to validate the data after the file is converted
         :return: Object of this class with data loaded
 
-        Additional keyword arguments are passed to `cls.to_json()` which is used to parse the converted file
+        Additional keyword arguments are passed to `cls.from_json()` which is used to parse the converted file
+
+        `flattentool` doesn't check the data against the schema, so unless
+        `validate=False` is passed the converted data will be validated once,
+        by `cls.from_json()`
 
         @TODO: better version of unflatten which allows for returning the data not a temporary file
         """
@@ -193,7 +402,7 @@ class ThreeSixtyGiving:
             metatab_name='Meta',
             metatab_vertical_orientation=True,
         )
-        c = cls.from_json(json_output, **kwargs)
+        c = cls.from_json(json_output, validate=validate, **kwargs)
         os.remove(json_output)
         return c
 
@@ -209,47 +418,127 @@ class ThreeSixtyGiving:
         :return: Object of this class with data loaded
 
         Additional keyword arguments are passed to `cls.__init__()` to produce the data
+
+        The JSON is parsed with `orjson`, which can only read integers that fit in
+        64 bits. See `cls.load_json()` for how larger integers are handled.
         """
-        opened_file = False
-        if isinstance(f, str):
-            fileobj, encoding = cls.guess_encoding(f)
-            opened_file = True
-        else:
-            fileobj = f
-        c = cls(json.load(fileobj), **kwargs)
-        if opened_file:
-            fileobj.close()
+        try:
+            if isinstance(f, str):
+                with open(f, 'rb') as fileobj:
+                    if os.fstat(fileobj.fileno()).st_size:
+                        # map the file into memory rather than reading in a copy of it
+                        with mmap.mmap(fileobj.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                            data = cls.load_json(mm)
+                    else:
+                        # empty files can't be mapped
+                        data = cls.load_json(fileobj.read())
+            else:
+                data = cls.load_json(f.read())
+        except (json.JSONDecodeError, UnicodeDecodeError) as error:
+            # `cls.load_json()` has already tried UTF-8, so for other
+            # encodings guess the encoding of the file and use the standard
+            # library instead
+            if not isinstance(f, str):
+                raise
+            for encoding in cls.possible_encodings(f):
+                if codecs.lookup(encoding).name in ('utf-8', 'utf-8-sig'):
+                    continue
+                try:
+                    with open(f, encoding=encoding) as fileobj:
+                        data = json.load(fileobj)
+                    break
+                except UnicodeDecodeError:
+                    # the guess was only checked against the start of the
+                    # file, so try the next one
+                    continue
+            else:
+                raise error
+
+        c = cls(data, **kwargs)
         if validate:
             c.fetch_schema()
             if not c.is_valid():
                 raise ParseError("Invalid file", c.errors)
         return c
 
+    @staticmethod
+    def load_json(contents):
+        """
+        Parse JSON data using `orjson`, skipping any UTF-8 byte order mark
+
+        `orjson` reads integers that don't fit in 64 bits as floats, which loses
+        precision. If the data contains a run of 19 or more digits, it is parsed
+        with the standard library `json` module instead, which keeps them exact.
+        The `json` module is also used if `orjson` can't parse the data, as it
+        accepts some things `orjson` doesn't, such as `NaN` and `Infinity`.
+
+        :param contents: JSON as a str or a bytes-like object (eg bytes or a memory-mapped file)
+        :return: The parsed data
+        :raises json.JSONDecodeError: if the data isn't valid JSON
+        :raises UnicodeDecodeError: if the data isn't encoded as UTF-8
+        """
+        if isinstance(contents, str):
+            contents = contents.encode('utf-8')
+
+        # orjson doesn't accept a byte order mark so skip past it. Using a
+        # memoryview means the contents aren't copied
+        start = len(codecs.BOM_UTF8) if contents[:len(codecs.BOM_UTF8)] == codecs.BOM_UTF8 else 0
+        with memoryview(contents) as view, view[start:] as json_view:
+            if not has_long_integer(json_view):
+                try:
+                    return orjson.loads(json_view)
+                except orjson.JSONDecodeError:
+                    pass
+            return json.loads(str(json_view, 'utf-8'))
+
     @classmethod
-    def guess_encoding(cls, f, encodings=None):
+    def guess_encoding(cls, f, encodings=None, sample_size=ENCODING_SAMPLE_SIZE):
         """
         Given a file will try to work out the encoding, based on running through
         a list of encodings and seeing whether any UnicodeDecodeErrors occur.
 
+        Only the first `sample_size` bytes of the file are checked.
+
         :param str f: path of the file to test
         :param list(str) encodings: list of encodings to test
+        :param int sample_size: number of bytes at the start of the file to test
         :return: Best guess at the file encoding
         :rtype: str
+        """
+        for e in cls.possible_encodings(f, encodings, sample_size):
+            return open(f, encoding=e), e
+        return None
 
-        @TODO: Could be more efficient by just opening the first part of the file
+    @classmethod
+    def possible_encodings(cls, f, encodings=None, sample_size=ENCODING_SAMPLE_SIZE):
+        """
+        Yields each of a list of encodings that the start of a file can be
+        decoded with, best guess first.
+
+        Only the first `sample_size` bytes of the file are checked, so the rest
+        of the file may not decode with an encoding given here. Encodings that
+        aren't available are skipped.
+
+        :param str f: path of the file to test
+        :param list(str) encodings: list of encodings to test
+        :param int sample_size: number of bytes at the start of the file to test
+        :return: Generator of encodings
+        :rtype: generator(str)
         """
         if encodings is None:
             encodings = ENCODINGS_TO_CHECK
 
+        with open(f, 'rb') as sample_file:
+            sample = sample_file.read(sample_size)
+
         for e in encodings:
             try:
-                encoding_file = open(f, encoding=e)
-                encoding_file.read()
-                encoding_file.seek(0)
-                return encoding_file, e
-            except UnicodeDecodeError:
+                # use an incremental decoder so a character cut off at the
+                # end of the sample doesn't count as an error
+                codecs.getincrementaldecoder(e)().decode(sample, final=False)
+            except (UnicodeDecodeError, LookupError):
                 continue
-        return None
+            yield e
 
     def fetch_schema(self, schema_url=None, schema=None):
         """
@@ -258,6 +547,7 @@ class ThreeSixtyGiving:
         As well as fetching the initial schema file, the function will also:
          - replace any references in the schema with the actual definitions (using JsonRed)
          - use `jsonschema` to create a validator that can be used to check documents against the schema
+         - use `fastjsonschema` to compile a quicker validator for checking whether a document is valid
          - create a dictionary of field name conversions (as regex) that can be used to replace field names with more user friendly ones
 
         The order of preference for loading a schema is:
@@ -267,6 +557,9 @@ class ThreeSixtyGiving:
         3. A schema fetched from schema_url provided to this method
         4. A schema fetched from the schema_url provided to this object
 
+        Schemas fetched from an URL are cached in `schema_cache`, so the
+        same URL is only fetched and processed once.
+
         :param str schema_url: URL of a JSON schema
         :param dict schema: dictionary containing a JSON schema
         :return: The full schema
@@ -276,9 +569,24 @@ class ThreeSixtyGiving:
         if schema_url is None:
             schema_url = self.schema_url
 
+        session = self.get_session()
+
         # if no schema is given or present already then load from URL
+        fetched_url = None
         if self.schema is None and schema is None:
-            self.schema = requests.get(schema_url).json()
+            # reuse a schema that has already been fetched from this URL
+            if schema_url in self.schema_cache:
+                (schema, self.validator, self.fast_validator,
+                 replace_names, replace_index) = self.schema_cache[schema_url]
+                # the validators can be shared, but copy anything that could
+                # be changed so that changes don't affect other instances
+                self.schema = copy.deepcopy(schema)
+                self.replace_names = OrderedDict(replace_names)
+                self.replace_index = {k: list(v) for k, v in replace_index.items()}
+                self.replace_index_names = OrderedDict(replace_names)
+                return self.schema
+            self.schema = session.get(schema_url).json()
+            fetched_url = schema_url
 
         # else if a schema has been given then use that one
         elif schema is not None:
@@ -287,44 +595,125 @@ class ThreeSixtyGiving:
         if self.schema is None:
             raise ValueError("No schema found")
 
-        # fetch the whole schema including references
-        self.schema = JsonRef.replace_refs(self.schema)
+        # fetch the whole schema including references. References are
+        # resolved relative to the schema URL, and fetched using the session
+        self.schema = JsonRef.replace_refs(
+            self.schema,
+            base_uri=fetched_url or '',
+            loader=self.schema_loader,
+        )
 
         # create a validator
         self.validator = Draft4Validator(
             self.schema, format_checker=FormatChecker())
 
-        # recursively find property names and titles
-        def recurse_names(props, replace_names=OrderedDict(), prefix_k='', prefix_v=''):
-            for i, prop in props.items():
-                name_k = '{}.([0-9]+).{}'.format(prefix_k, i) if prefix_k != '' else i
-                name_v = '{}:\\1:{}'.format(prefix_v, prop.get(
-                    "title", i)) if prefix_v != '' else prop.get("title", i)
+        # compile a faster validator that can only say whether data is valid
+        # the jsonschema validator is still used to give details of any errors
+        try:
+            self.fast_validator = compile_fast_validator(self.schema)
+        except fastjsonschema.JsonSchemaDefinitionException:
+            self.fast_validator = None
+
+        # find property names and titles, descending into arrays of objects.
+        # The stack holds an iterator over each level of properties, so the
+        # names are added in the same order as the schema
+        self.replace_names = OrderedDict()
+        stack = [(
+            iter(self.schema['properties'][self.root_id]['items']['properties'].items()),
+            '',
+            ''
+        )]
+        while stack:
+            props, prefix_k, prefix_v = stack[-1]
+            for i, prop in props:
+                title = prop.get("title", i)
+                name_k = f'{prefix_k}.([0-9]+).{i}' if prefix_k else i
+                name_v = f'{prefix_v}:\\1:{title}' if prefix_v else title
                 if prop.get("type") == 'array':
-                    replace_names = recurse_names(
-                        prop.get("items", {}).get("properties", {}),
-                        replace_names,
-                        name_k,
-                        name_v
-                    )
+                    items = prop.get("items")
+                    if items and "properties" in items:
+                        stack.append((iter(items["properties"].items()), name_k, name_v))
+                        break
                 else:
-                    replace_names[name_k] = name_v
-            return replace_names
+                    self.replace_names[name_k] = name_v
+            else:
+                stack.pop()
 
-        self.replace_names = recurse_names(
-            self.schema['properties'][self.root_id]['items']['properties'],
-            self.replace_names
-        )
+        self.get_replace_index()
+
+        if fetched_url is not None:
+            self.schema_cache[fetched_url] = (
+                copy.deepcopy(self.schema), self.validator, self.fast_validator,
+                OrderedDict(self.replace_names),
+                {k: list(v) for k, v in self.replace_index.items()})
 
         return self.schema
 
 
-    def get_errors(self, data=None):
+    def fast_check(self, data=None):
+        """
+        Using the compiled validator created by `fetch_schema`, quickly check
+        whether a dataset is valid, without finding details of any errors
+
+        :param dict data: Data to check
+        :return: True if the data is valid. False if it isn't, or if there is no compiled validator to check with
+        :rtype: bool
+        """
+        if self.fast_validator is None:
+            return False
+
+        if data is None:
+            data = self.data
+
+        try:
+            self.fast_validator(data)
+        except fastjsonschema.JsonSchemaException:
+            return False
+        return True
+
+    def get_errors(self, data=None, fast_check=True):
         """
         Using the schema and validator created by `fetch_schema`, validate
         a dataset and yield any errors that result
 
         :param dict data: Data to check for errors
+        :param bool fast_check: Whether to check the data with `self.fast_check()` before looking for errors
+        :return: Iterator of any errors found in the data
+        """
+        # if no schema given then we can't error check
+        if self.schema is None or self.validator is None:
+            raise ValueError("No schema available to check")
+
+        if data is None:
+            data = self.data
+
+        # valid data won't produce any errors, so check quickly first
+        if fast_check and self.fast_check(data):
+            return
+
+        yield from self.filter_errors(self.validator.iter_errors(data))
+
+    def get_errors_parallel(self, data=None, workers=None, chunksize=1000):
+        """
+        Validate a dataset and yield any errors that result, checking the
+        grants in parallel using a pool of worker processes
+
+        Everything apart from the individual grants is checked in this process.
+        The grants are split into chunks, and each worker checks its chunks with a
+        compiled validator. Any grants that fail are then checked again here with
+        the `jsonschema` validator to find the details of the errors.
+
+        The errors are the same as those from `self.get_errors()`, but may be in a
+        different order.
+
+        If there is no compiled validator (because `fastjsonschema` couldn't
+        compile the schema) or the data has no list of grants, this falls back
+        to checking everything in this process using `self.get_errors()`. A
+        `RuntimeWarning` is given if this happens when `workers` was set.
+
+        :param dict data: Data to check for errors
+        :param int workers: Number of worker processes (defaults to the number of CPUs)
+        :param int chunksize: Number of grants sent to a worker at a time
         :return: Iterator of any errors found in the data
         """
         # if no schema given then we can't error check
@@ -334,7 +723,60 @@ class ThreeSixtyGiving:
         if data is None:
             data = self.data
 
-        for e in self.validator.iter_errors(data):
+        grants = data.get(self.root_id) if isinstance(data, dict) else None
+        if self.fast_validator is None or not isinstance(grants, list):
+            if workers is not None:
+                warnings.warn(
+                    "Can't check the grants in parallel, checking them in this process instead",
+                    RuntimeWarning)
+            yield from self.get_errors(data)
+            return
+
+        # check the package without the schema for individual grants
+        package_schema = dict(self.schema)
+        package_schema['properties'] = dict(package_schema['properties'])
+        package_schema['properties'][self.root_id] = {
+            k: v for k, v in package_schema['properties'][self.root_id].items()
+            if k != 'items'
+        }
+        try:
+            compile_fast_validator(package_schema)(data)
+        except fastjsonschema.JsonSchemaException:
+            package_validator = Draft4Validator(
+                package_schema, format_checker=FormatChecker())
+            yield from self.filter_errors(package_validator.iter_errors(data))
+
+        # find grants that fail using the worker processes
+        grant_schema = self.schema['properties'][self.root_id]['items']
+        chunks = [
+            (start, grants[start:start + chunksize])
+            for start in range(0, len(grants), chunksize)
+        ]
+        with ProcessPoolExecutor(
+                max_workers=workers,
+                initializer=init_grant_validator,
+                initargs=(plain_schema(grant_schema),)) as executor:
+            invalid = [i for chunk in executor.map(find_invalid_grants, chunks) for i in chunk]
+
+        # then get the details of the errors for those grants
+        if invalid:
+            grant_validator = Draft4Validator(
+                grant_schema, format_checker=FormatChecker())
+            for i in invalid:
+                for e in self.filter_errors(grant_validator.iter_errors(grants[i])):
+                    # make the paths relative to the whole package
+                    e.path.extendleft([i, self.root_id])
+                    e.schema_path.extendleft(['items', self.root_id, 'properties'])
+                    yield e
+
+    def filter_errors(self, errors):
+        """
+        Remove any errors that should be ignored from the errors found by a validator
+
+        :param errors: Iterator of `jsonschema` errors
+        :return: Iterator of the errors that aren't ignored
+        """
+        for e in errors:
             # ignore error where the datetime value is one of a type
             if e.validator == 'oneOf' and e.validator_value[0] == {'format': 'date-time'}:
                 continue
@@ -344,11 +786,17 @@ class ThreeSixtyGiving:
         """
         Check whether the current object has a valid file against the schema
 
+        The data is first checked with `self.fast_check()`, and only if that
+        fails are the details of the errors found with `self.get_errors()`
+
         :return: True|False whether the file is valid or not. Returns None if validity hasn't been checked (eg not data)
         :rtype: bool or None
         """
         if self.valid is None and self.data:
-            self.errors = list(self.get_errors(self.data))
+            if self.fast_check(self.data):
+                self.errors = []
+            else:
+                self.errors = list(self.get_errors(self.data, fast_check=False))
             self.valid = len(self.errors) == 0
 
         return self.valid
@@ -357,15 +805,64 @@ class ThreeSixtyGiving:
         """
         Convert data into a JSON file
 
-        :param f: Either a file path or an open fileobj. If a fileobj is provided it won't close it afterwards
+        The JSON is written using `orjson`, with an indent of two spaces. `orjson`
+        can't write integers that don't fit in 64 bits, so if the data contains
+        any the standard library `json` module is used instead.
+
+        :param f: Either a file path or an open fileobj (text or binary). If a fileobj is provided it won't close it afterwards
         """
-        closefile = False
+        try:
+            output = orjson.dumps(
+                self.data, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)
+        except orjson.JSONEncodeError:
+            output = json.dumps(self.data, indent=2, ensure_ascii=False).encode('utf-8')
         if isinstance(f, str):
-            f = open(f, 'w')
-            closefile = True
-        json.dump(self.data, f, indent=4, ensure_ascii=False)
-        if closefile:
-            f.close()
+            with open(f, 'wb') as fileobj:
+                fileobj.write(output)
+        elif self.is_binary_file(f):
+            f.write(output)
+        else:
+            f.write(output.decode('utf-8'))
+
+    @staticmethod
+    def is_binary_file(f):
+        """
+        Check whether a fileobj expects bytes rather than str to be written to it
+
+        Anything that isn't clearly binary (eg wrappers like
+        `tempfile.NamedTemporaryFile`) is treated as a text file
+
+        :param f: An open fileobj
+        :rtype: bool
+        """
+        if isinstance(f, (io.RawIOBase, io.BufferedIOBase)):
+            return True
+        mode = getattr(f, 'mode', '')
+        return isinstance(mode, str) and 'b' in mode
+
+    def iter_flat(self):
+        """
+        Iterate through the grants, yielding each one as a "flat" dict
+
+        See `self.to_flatfile()` for a description of the flat format
+        """
+        # flatten the grant dictionaries directly rather than creating Grant objects
+        for g in self.data.get(self.root_id, []):
+            yield flatten_dict(g)
+
+    def flat_fieldnames(self):
+        """
+        Get the fieldnames found in the "flat" version of the grants
+
+        :return: List of fieldnames, in the order they first appear
+        :rtype: list
+        """
+        # dict keys are used as an ordered set of the fieldnames
+        fieldnames = OrderedDict()
+        for g_flat in self.iter_flat():
+            for f in g_flat:
+                fieldnames[f] = None
+        return list(fieldnames)
 
     def to_flatfile(self):
         """
@@ -379,14 +876,13 @@ class ThreeSixtyGiving:
         :rtype: tuple
         """
         data = []
-        fieldnames = []
-        for g in self:
-            g_flat = g.to_flat()
+        # dict keys are used as an ordered set of the fieldnames
+        fieldnames = OrderedDict()
+        for g_flat in self.iter_flat():
             data.append(g_flat)
-            for f in g_flat.keys():
-                if f not in fieldnames:
-                    fieldnames.append(f)
-        return (data, fieldnames)
+            for f in g_flat:
+                fieldnames[f] = None
+        return (data, list(fieldnames))
 
     def to_csv(self, f, convert_fieldnames=True):
         """
@@ -396,21 +892,24 @@ class ThreeSixtyGiving:
         :param bool convert_fieldnames: Whether to convert fieldnames into a more friendly format or not (uses the dictionary created in `self.fetch_schema()`)
 
         Note: closes the file after writing the data
+
+        The grants are flattened twice, once to find the fieldnames and once
+        to write the rows, so the whole flat dataset isn't held in memory.
         """
+        fieldnames = self.flat_fieldnames()
+
         closefile = False
         if isinstance(f, str):
-            f = open(f, 'w')
+            f = open(f, 'w', buffering=1 << 20)
             closefile = True
 
-        data, fieldnames = self.to_flatfile()
-
-        writer = csv.DictWriter(f, fieldnames=fieldnames)
+        writer = csv.writer(f)
         if convert_fieldnames:
-            writer.writerow(self.convert_fieldnames(fieldnames))
+            writer.writerow(self.convert_fieldnames(fieldnames).values())
         else:
-            writer.writeheader()
-        for r in data:
-            writer.writerow(r)
+            writer.writerow(fieldnames)
+        for r in self.iter_flat():
+            writer.writerow([r.get(fn) for fn in fieldnames])
         if closefile:
             f.close()
 
@@ -430,9 +929,11 @@ class ThreeSixtyGiving:
             raise NotImplementedError("Not yet able to do multiple sheets")
         else:
 
-            data, fieldnames = self.to_flatfile()
+            fieldnames = self.flat_fieldnames()
 
-            workbook = xlsxwriter.Workbook(f)
+            # constant_memory mode writes each row to disk once the next row
+            # is started, so the rows must be written in order
+            workbook = xlsxwriter.Workbook(f, {'constant_memory': True})
             worksheet = workbook.add_worksheet()
 
             # write header
@@ -442,8 +943,12 @@ class ThreeSixtyGiving:
                 worksheet.write_row(0, 0, fieldnames)
 
             # write rows
-            for row, r in enumerate(data):
-                worksheet.write_row(row+1, 0, [r.get(f) for f in fieldnames])
+            positions = {fn: i for i, fn in enumerate(fieldnames)}
+            for row, r in enumerate(self.iter_flat()):
+                values = [None] * len(fieldnames)
+                for fn, value in r.items():
+                    values[positions[fn]] = value
+                worksheet.write_row(row+1, 0, values)
             workbook.close()
 
     to_xlsx = to_excel # alias for to_excel
@@ -457,13 +962,40 @@ class ThreeSixtyGiving:
         :raises: ImportError if pandas is not installed
         """
         import pandas
-        data, fieldnames = self.to_flatfile()
-        df = pandas.DataFrame(data)
+
+        # build a list of values for each column, rather than a list of rows
+        fieldnames = self.flat_fieldnames()
+        rows = len(self.data.get(self.root_id, []))
+        columns = {fn: [float('nan')] * rows for fn in fieldnames}
+        for row, r in enumerate(self.iter_flat()):
+            for fn, value in r.items():
+                columns[fn][row] = value
+
+        df = pandas.DataFrame(columns, columns=fieldnames)
         if convert_fieldnames:
             df = df.rename(columns=self.convert_fieldnames(fieldnames))
 
         return df
 
+    def get_replace_index(self):
+        """
+        Get the compiled versions of the regexes in `self.replace_names`,
+        grouped by the first part of the fieldname
+
+        The regexes are compiled once, rather than for every field, so each
+        field is only checked against the patterns that could match it. They
+        are compiled again if `self.replace_names` has changed.
+
+        :return: Dictionary of first part of the fieldname: list of (compiled regex, replacement)
+        """
+        if self.replace_index_names != self.replace_names:
+            self.replace_index = {}
+            for old, new in self.replace_names.items():
+                self.replace_index.setdefault(old.split('.', 1)[0], []).append(
+                    (re.compile(old), new))
+            self.replace_index_names = OrderedDict(self.replace_names)
+        return self.replace_index
+
     def convert_fieldnames(self, fieldnames):
         """
         Applies the transformations in `self.replace_names` to a set of fieldnames
@@ -471,12 +1003,18 @@ class ThreeSixtyGiving:
         :param list[str] fieldnames: A list of fieldnames to replace
         :return: Dictionary of old:new values for fieldnames
         """
-        fieldnames = OrderedDict(zip(fieldnames, fieldnames))
-        for old, new in self.replace_names.items():
-            for field in fieldnames:
-                if re.fullmatch(old, field):
-                    fieldnames[field] = re.sub(old, new, field)
-        return fieldnames
+        replace_index = self.get_replace_index()
+        converted = OrderedDict()
+        for field in fieldnames:
+            converted[field] = field
+            # where more than one pattern matches the last one is used
+            patterns = replace_index.get(field.split('.', 1)[0], [])
+            for pattern, new in reversed(patterns):
+                match = pattern.fullmatch(field)
+                if match:
+                    converted[field] = match.expand(new)
+                    break
+        return converted
 
 
 class Grant:
@@ -496,19 +1034,32 @@ class Grant:
 
         Nested fields are turned into the form `key.0.subkey`
         """
-        def flatten(vals, prefix=''):
-            new_vals = []
-            if isinstance(vals, list):
-                vals = dict(zip(map(str, range(len(vals))), vals))
-
-            for v in vals:
-                new_key = '{}.{}'.format(prefix, v) if prefix != '' else v
-                if isinstance(vals[v], list):
-                    new_vals.extend(flatten(vals[v], new_key))
-                elif isinstance(vals[v], dict):
-                    new_vals.extend(flatten(vals[v], new_key))
-                else:
-                    new_vals.append((new_key, vals[v]))
-            return new_vals
+        return flatten_dict(self.__dict__)
+
+
+def flatten_dict(d):
+    """
+    Turn a nested dictionary into a flat dictionary of key:values
+
+    Nested fields are turned into the form `key.0.subkey`
+
+    :param dict d: The nested dictionary (eg a single grant)
+    :return: Flattened version of the dictionary
+    :rtype: OrderedDict
+    """
+    # walk the object using a stack rather than recursion. Items are
+    # popped in reverse order, so the result is reversed at the end
+    flat = []
+    stack = [('', d)]
+    while stack:
+        prefix, vals = stack.pop()
+        if isinstance(vals, dict):
+            for k, v in vals.items():
+                stack.append((f'{prefix}.{k}' if prefix else k, v))
+        elif isinstance(vals, list):
+            for k, v in enumerate(vals):
+                stack.append((f'{prefix}.{k}', v))
+        else:
+            flat.append((prefix, vals))
 
-        return OrderedDict(flatten(self.__dict__))
+    return OrderedDict(reversed(flat))